@@ -1,4 +1,6 @@
+import os
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from jwst.stpipe import Step
 from jwst import datamodels
 
@@ -10,6 +12,29 @@ import logging
 log = logging.getLogger(__name__)
 log.setLevel(logging.DEBUG)
 
+_SAT = datamodels.dqflags.pixel['SATURATED']
+_DNU = datamodels.dqflags.pixel['DO_NOT_USE']
+
+# Gain and RON subarrays already loaded, keyed by reference files,
+# subarray geometry and frames per group
+_gain_ron_cache = {}
+
+# CRDS reference file names already resolved, keyed by reference type,
+# instrument configuration and observation date
+_reffile_cache = {}
+
+def _get_reference_file(input_model, reftype):
+    """
+    Returns the CRDS reference file of type reftype for input_model, resolving
+    it only once for segments sharing observation date and configuration.
+    """
+    meta = input_model.meta
+    key = (reftype, meta.instrument.name, meta.instrument.detector, meta.subarray.name,
+           meta.exposure.readpatt, meta.exposure.type, meta.observation.date)
+    if key not in _reffile_cache:
+        _reffile_cache[key] = Step().get_reference_file(input_model, reftype)
+    return _reffile_cache[key]
+
 def get_gain_ron_2d(input_model):
     """ 
     Returns the readnoise and gain subarray in units of counts (electrons).
@@ -21,6 +46,10 @@ def get_gain_ron_2d(input_model):
     reproducing in part the functionality implemented in the standard pipeline 
     RampFitStep.
     
+    Reference file names and subarrays are cached, so that segments of the
+    same exposure query CRDS and open the reference files only once. The
+    returned arrays are read-only.
+    
     Parameters
     ----------
     input_model : data model
@@ -35,22 +64,80 @@ def get_gain_ron_2d(input_model):
         gain subarray in units of CT
     
     """
-    st =  Step()
-    readnoise_filename = st.get_reference_file(input_model, 'readnoise')
-    gain_filename = st.get_reference_file(input_model, 'gain')
+    readnoise_filename = _get_reference_file(input_model, 'readnoise')
+    gain_filename = _get_reference_file(input_model, 'gain')
     frames_per_group = input_model.meta.exposure.nframes
     log.info('Using READNOISE reference file: %s', readnoise_filename)
     log.info('Using GAIN reference file: %s', gain_filename)
     
-    with datamodels.ReadnoiseModel(readnoise_filename) as readnoise_model, \
-        datamodels.GainModel(gain_filename) as gain_model:
-            
-            if gain_model.meta.exposure.gain_factor is not None:
-                input_model.meta.exposure.gain_factor = gain_model.meta.exposure.gain_factor
-            frames_per_group = input_model.meta.exposure.nframes
-            readnoise_2d, gain_2d = get_reference_file_subarrays(input_model, readnoise_model, gain_model, frames_per_group) 
-    return gain_2d, readnoise_2d*gain_2d
+    subarray = input_model.meta.subarray
+    key = (readnoise_filename, gain_filename,
+           subarray.xstart, subarray.ystart, subarray.xsize, subarray.ysize,
+           frames_per_group)
+    
+    if key not in _gain_ron_cache:
+        with datamodels.ReadnoiseModel(readnoise_filename) as readnoise_model, \
+            datamodels.GainModel(gain_filename) as gain_model:
+                
+                gain_factor = gain_model.meta.exposure.gain_factor
+                readnoise_2d, gain_2d = get_reference_file_subarrays(input_model, readnoise_model, gain_model, frames_per_group) 
+        
+        gain_2d = gain_2d.astype(np.float32, copy=False)
+        readnoise_2d = readnoise_2d.astype(np.float32, copy=False)*gain_2d
+        gain_2d.setflags(write=False)
+        readnoise_2d.setflags(write=False)
+        _gain_ron_cache[key] = (gain_factor, gain_2d, readnoise_2d)
+    
+    gain_factor, gain_2d, readnoise_2d = _gain_ron_cache[key]
+    if gain_factor is not None:
+        input_model.meta.exposure.gain_factor = gain_factor
+    return gain_2d, readnoise_2d
+
+
+def _cds_kernel(data, groupdq, pixeldq, first_j):
+    """
+    Returns the CDS rate, dq mask and number of groups, computed in a single
+    pass over all integrations and columns.
+    
+    Parameters
+    ----------
+    data, groupdq : 4D arrays
+        ramp data and group dq, of shape (nints, ngroups, nrows, ncols)
+
+    pixeldq : 2D array
+        pixel dq, of shape (nrows, ncols)
 
+    first_j : int, 2D array
+        earliest saturation transient for each integration and column, of
+        shape (nints, ncols). Columns that never saturate are set to ngroups.
+
+    Returns
+    -------
+    cds, mask, ngroup : 3D arrays
+        of shape (nints, nrows, ncols)
+    """
+    n1 = data.shape[1]
+    
+    # note: j = 0 if saturation occurs in group 1.   CDS cannot be estimated
+    #       j = 1 if saturation occurs in group 2.   CDS estimated from groups 1 and 0; ngroup = 1
+    #       j = 2 if saturation occurs in group 3.   CDS estimated from groups 2 and 0; ngroup = 2
+    #                ...                             ...                                ...
+    #                saturation occurs in group j+1. CDS estimated from groups j and 0; ngroup = j
+    #       j = n1-1 if the column does not saturate. CDS estimated from the last and first groups
+    j = np.where(first_j < n1, first_j, n1-1)[:, np.newaxis, :]
+    j_index = j[:, np.newaxis, :, :]
+    
+    cds = np.subtract(np.take_along_axis(data, j_index, axis=1)[:, 0], data[:, 0],
+                      dtype=np.float32)
+    cds /= np.where(j == 0, 1, j).astype(np.float32)
+    
+    mask = np.take_along_axis(groupdq, j_index, axis=1)[:, 0] | groupdq[:, 0] | pixeldq | \
+           np.where(j == 0, _DNU, 0).astype(np.uint32)
+    
+    ngroup = np.empty_like(cds)
+    ngroup[...] = np.where(j == 0, np.nan, j)
+    
+    return cds, mask, ngroup
 
 
 class CDSCustomStep(Step):
@@ -66,12 +153,14 @@ class CDSCustomStep(Step):
     
     If  𝑔=0, then the CDS cannot be build and is flagged DO_NOT_USE.
 
-    To implement this, I estimate the difference across group flags, and select
-    transients, i.e. select those columns that are set to saturated in  𝑔, but 
-    are not in  𝑔−1.
+    To implement this, I select saturation transients, i.e. those columns that
+    are set to saturated in  𝑔, but are not in  𝑔−1, and take the earliest one
+    for each integration and column.
 
-    Then I select the frames, groups and colums that are newly saturated, and 
-    replace the default CDS with the new one.The CDS is normalised to the number of groups (ngroup) used to estimate it. Therefore, it is a rate, rather than a classical CDS.
+    The CDS of each column is then built in a single pass from the last usable
+    group: group  𝑔−1 if the column saturates in  𝑔, the last group otherwise.
+    The CDS is normalised to the number of groups (ngroup) used to estimate it.
+    Therefore, it is a rate, rather than a classical CDS.
 
     Shot noise variance is proportional to the signal:
         𝑉𝑎𝑟𝑃=𝐶𝐷𝑆/ngroup∝1/ngroup
@@ -96,34 +185,38 @@ class CDSCustomStep(Step):
             
             n0, n1, n2, n3 = input_model.shape
             
-            p = np.diff(
-                input_model.groupdq[:,:,n2//2,:] & datamodels.dqflags.pixel['SATURATED'], 
-                axis=1)
-            idx = np.where(p == datamodels.dqflags.pixel['SATURATED'])
-
-            # Define defaults
-            cds  = (input_model.data[:, -1, :, :] - input_model.data[:, 0, :, :])/(n1-1)
-            mask = input_model.groupdq[:, -1, :, :] | input_model.groupdq[:, 0, :, :] | input_model.pixeldq
-            ngroup = np.zeros_like(cds) + (n1-1)
-
-            for i, j, k in zip(*idx):
-                # note: j = 0 if saturation occurs in group 1.   CDS cannot be estimated
-                #       j = 1 if saturation occurs in group 2.   CDS estimated from groups 1 and 0; ngroup = 1
-                #       j = 2 if saturation occurs in group 3.   CDS estimated from groups 2 and 0; ngroup = 2
-                #                ...                             ...                                ...
-                #                saturation occurs in group j+1. CDS estimated from groups j and 0; ngroup = j
-
-                norm = 1 if j == 0 else j
-                do_not_use = datamodels.dqflags.pixel['DO_NOT_USE'] if j == 0 else 0
-                #do_not_use = dqflags.pixel['DO_NOT_USE'] 
-                cds[i, :, k]    = (input_model.data[i, j, :, k] - input_model.data[i, 0, :, k])/norm
-                mask[i, :, k]   = input_model.groupdq[i, j, :, k] | input_model.groupdq[i, 0, :, k] | \
-                                  input_model.pixeldq[:, k] | do_not_use
-                ngroup[i, :, k] = np.nan if j == 0 else j
+            # Saturation transients: columns saturated in group j+1 but not in j
+            sat = (input_model.groupdq[:, :, n2//2, :] & _SAT) > 0
+            transient = sat[:, 1:, :] & ~sat[:, :-1, :]
+
+            # Earliest saturation transient for each (integration, column) pair;
+            # n1 marks columns that never saturate.
+            first_j = np.where(transient.any(axis=1), transient.argmax(axis=1), n1)
+            
+            cds    = np.empty((n0, n2, n3), dtype=np.float32)
+            mask   = np.empty((n0, n2, n3), dtype=np.uint32)
+            ngroup = np.empty((n0, n2, n3), dtype=np.float32)
+            
+            def cds_chunk(c):
+                cds[c], mask[c], ngroup[c] = _cds_kernel(
+                    input_model.data[c], input_model.groupdq[c], input_model.pixeldq, first_j[c])
+            
+            # Integrations are independent and numpy releases the GIL
+            nchunks = min(os.cpu_count() or 1, n0)
+            chunks = [slice(c[0], c[-1]+1) for c in np.array_split(np.arange(n0), nchunks)]
+            with ThreadPoolExecutor(max_workers=nchunks) as executor:
+                list(executor.map(cds_chunk, chunks))
     
         cds  = np.ma.array(data= gain_2d*cds, mask=mask > 0)
         varP = cds/ngroup
         varR = np.ma.array(data=2*readnoise_2d**2/ngroup**2, mask=mask > 0)
+        
+        # sqrt taken in place on the raw sum; as np.ma.sqrt did, masked entries
+        # of either variance, non-finite and negative sums are masked
+        err = np.add(varP.data, varR.data)
+        np.sqrt(err, out=err, where=err >= 0)
+        err = np.ma.array(data=err, mask=np.ma.getmaskarray(varP) | np.ma.getmaskarray(varR) |
+                                         ~np.isfinite(err) | (err < 0))
 
             
         out_model = datamodels.CubeModel(
@@ -131,7 +224,7 @@ class CDSCustomStep(Step):
             dq = mask,
             var_poisson = varP,
             var_rnoise = varR,
-            err = np.ma.sqrt(varP + varR),
+            err = err,
             int_times = input_model.int_times.copy()
         )
         
@@ -1,15 +1,36 @@
-from astropy.stats import sigma_clip
+import os
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from jwst.stpipe import Step
 from jwst import datamodels
 
+from .stats import nanmedian
+
+_OUTLIER_FLAG = datamodels.dqflags.pixel['JUMP_DET'] | datamodels.dqflags.pixel['DO_NOT_USE']
+
+def _mad_clip_mask(data, sigma=5):
+    """
+    Outlier mask of data along the temporal axis (axis 0). Samples deviating
+    from the median by more than sigma times the normalised median absolute
+    deviation (MAD) are masked, together with non-finite and already masked
+    samples, which are excluded from the median and the MAD.
+    """
+    invalid = np.ma.getmaskarray(data) | ~np.isfinite(np.ma.getdata(data))
+    data = np.where(invalid, np.nan, np.ma.getdata(data))
+    deviation = np.abs(data - nanmedian(data, axis=0))
+    mad = 1.4826*nanmedian(deviation, axis=0)
+    return ~(deviation <= sigma*mad)
+
 class FlaggingCustomStep(Step):
     """
     Flag outlier¶
-    Here we use the sigma_clip Astropy implementation, applied pixel-by-pixel
-    along the temporal axis. This is not fully "correct" because of the 
-    transit signal contributing to the RMS. In principle, the transit signal 
-    should be removed before applying the the sigma_clip. We will consider 
-    a more robust algorithm if needed, later on.
+    Here we use a single-pass 5-sigma clip, applied pixel-by-pixel along the
+    temporal axis, with the sigma estimated from the median absolute deviation
+    (MAD). This is more robust to outliers than an iterated mean and standard
+    deviation, but still not fully "correct" because of the transit signal 
+    contributing to the dispersion. In principle, the transit signal should be
+    removed before clipping. We will consider a more robust algorithm if 
+    needed, later on.
     """
     
     class_alias = "Flagging"
@@ -21,12 +42,33 @@ class FlaggingCustomStep(Step):
     """
     def process(self, input):
         with datamodels.CubeModel(input) as input_model:
-            _cds_ = sigma_clip(input_model.data, sigma=5, axis=0)
+            n0, n1, n2 = input_model.shape
+            
+            # Pixels are clipped independently: process blocks of rows concurrently
+            nchunks = min(os.cpu_count() or 1, n1)
+            rows = [slice(r[0], r[-1]+1) for r in np.array_split(np.arange(n1), nchunks)]
+            with ThreadPoolExecutor(max_workers=nchunks) as executor:
+                masks = list(executor.map(
+                    lambda r: _mad_clip_mask(input_model.data[:, r, :]), rows))
+            
+            _cds_ = np.ma.array(input_model.data, mask=np.concatenate(masks, axis=1))
             
             new_outliers = (input_model.dq > 0) ^ _cds_.mask 
-            out_model = input_model.copy()
-        
-        out_model.dq[new_outliers] |= datamodels.dqflags.pixel['JUMP_DET'] | datamodels.dqflags.pixel['DO_NOT_USE']
-        out_model.data = _cds_
+            dq = input_model.dq.copy()
+            dq[new_outliers] |= _OUTLIER_FLAG
+            
+            # Only dq changes: share all other arrays with input_model
+            out_model = datamodels.CubeModel(
+                data = _cds_,
+                dq = dq,
+                var_poisson = input_model.var_poisson,
+                var_rnoise = input_model.var_rnoise,
+                err = input_model.err,
+                int_times = input_model.int_times
+            )
+            out_model.update(input_model)
+            for name in ('ngroup', 'background'):
+                if hasattr(input_model, name):
+                    setattr(out_model, name, getattr(input_model, name))
         
         return out_model
@@ -2,6 +2,8 @@ import numpy as np
 from jwst.stpipe import Step
 from jwst import datamodels
 
+from .stats import nanmedian
+
 class ReferenceCorrectionCustomStep(Step):
     """
     Background and 1/f noise correction
@@ -14,6 +16,9 @@ class ReferenceCorrectionCustomStep(Step):
     In the same step, I update the pixel noise estimates:
         shot noise variance: unchanged.
         RON variance: is increaded becasue of the pixel-wise background subtraction
+    
+    With inplace=True the data and RON variance of the input model are
+    overwritten, instead of being allocated anew.
     """
     
     class_alias = "RefCorr"
@@ -22,23 +27,50 @@ class ReferenceCorrectionCustomStep(Step):
         int_name = string(default='')
         save_opt = boolean(default=False) # Save optional output
         opt_name = string(default='')
+        inplace  = boolean(default=False) # Overwrite the input data and var_rnoise
     """
     def process(self, input):
         with datamodels.CubeModel(input) as input_model:
             n0, n1, n2 = input_model.shape
-            background = np.ma.stack( 
+            # Flagged reference pixels (masked in the CDS output) are set to
+            # NaN and ignored by the median
+            background = np.ma.filled(np.ma.concatenate(
                 (input_model.data[:,0:6, :], input_model.data[:, -6:, :]), 
                 axis=1
-            ).reshape(n0, -1, n2)
-            median_background = np.ma.median(background, axis = 1)
+            ).astype(np.float32), np.nan)
+            
+            median_background = nanmedian(background, axis = 1)
+            
+            # Columns with no valid reference pixel cannot be corrected: they
+            # are masked, and are flagged as outliers in FlaggingCustomStep
+            no_reference = np.isnan(median_background)
+            median_background[no_reference] = 0.0
+            
+            data = input_model.data if self.inplace else np.empty_like(input_model.data)
+            np.subtract(input_model.data,
+                        median_background[:, np.newaxis, :],
+                        out=data)
+            data = np.ma.array(data,
+                               mask=np.ma.getmaskarray(input_model.data) | no_reference[:, np.newaxis, :])
+            
+            # Update noise estimates
+            #   not fully correct as it does not account for 
+            #   flagged pixel and outliers
+            var_rnoise = input_model.var_rnoise if self.inplace else np.empty_like(input_model.var_rnoise)
+            np.multiply(input_model.var_rnoise, 1.0 + 1.0/background.shape[1], out=var_rnoise)
             
-            output_model = input_model.copy()
-            for k in range(n0):
-                output_model.data[k] = input_model.data[k]-median_background[k]
+            # Share the unchanged arrays with input_model
+            output_model = datamodels.CubeModel(
+                data = data,
+                dq = input_model.dq,
+                var_poisson = input_model.var_poisson,
+                var_rnoise = var_rnoise,
+                err = input_model.err,
+                int_times = input_model.int_times
+            )
+            output_model.update(input_model)
+            if hasattr(input_model, 'ngroup'):
+                setattr(output_model, 'ngroup', input_model.ngroup)
             
-        # Update noise estimates
-        #   not fully correct as it does not account for 
-        #   flagged pixel and outliers
-        output_model.var_rnoise  *= 1.0 + 1.0/background.shape[1] 
-        setattr(output_model, "background", median_background)
+        setattr(output_model, "background", np.ma.array(median_background, mask=no_reference))
         return output_model
@@ -0,0 +1,30 @@
+import numpy as np
+
+def nanmedian(a, axis=0):
+    """
+    Median of a along axis, ignoring NaNs. Slices with no valid entries give
+    NaN, without warnings.
+
+    np.nanmedian along an axis goes through np.ma.median for short axes and a
+    per-slice Python loop for long ones. Here a single sort places the NaNs
+    last, and the median is read at the middle of the valid entries of each
+    slice.
+
+    Parameters
+    ----------
+    a : array
+        input array
+
+    axis : int
+        axis along which the median is computed
+
+    Returns
+    -------
+    median : array
+        same shape as a, with axis removed
+    """
+    a = np.sort(a, axis=axis)
+    count = np.expand_dims(np.count_nonzero(~np.isnan(a), axis=axis), axis)
+    lo = np.take_along_axis(a, np.maximum(count-1, 0)//2, axis=axis)
+    hi = np.take_along_axis(a, count//2, axis=axis)
+    return np.squeeze(0.5*(lo + hi), axis=axis)
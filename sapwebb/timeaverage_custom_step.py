@@ -1,7 +1,17 @@
+import os
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from jwst.stpipe import Step
 from jwst import datamodels
 
+def _masked_mean(a, valid, count, out):
+    """
+    Mean of a along axis 1 restricted to the valid entries, written to out.
+    Elements with no valid entries (count == 0) are set to 0.0.
+    """
+    np.sum(a, axis=1, where=valid, out=out)
+    return np.divide(out, count, out=out, where=count > 0)
+
 class TimeAverageStep(Step):
     """
     Time average the pixel timeline    
@@ -21,31 +31,46 @@ class TimeAverageStep(Step):
         with datamodels.CubeModel(input) as input_model:
             n0, n1, n2 = input_model.shape
             new_n0 = n0 - n0%num_ave
-            mask = input_model.dq[0:new_n0, ...] > 0
-            data = np.ma.array(data = input_model.data[0:new_n0, ...],
-                              mask = mask,
-                              fill_value = 0.0)
-            varp = np.ma.array(data = input_model.var_poisson[0:new_n0, ...],
-                              mask = mask,
-                              fill_value = 0.0)
-            varr = np.ma.array(data = input_model.var_rnoise[0:new_n0, ...],
-                              mask = mask,
-                              fill_value = 0.0)
-            count = data.reshape(-1, num_ave, n1, n2).count(axis=1)
-            data  = data.reshape(-1, num_ave, n1, n2).mean(axis=1)
-            varp  = varp.reshape(-1, num_ave, n1, n2).mean(axis=1)/count
-            varr  = varr.reshape(-1, num_ave, n1, n2).mean(axis=1)/count
-            err   = np.sqrt(varp + varr)
-            dq    = np.ma.getmask(data).astype(np.uint32)
+            shape = (-1, num_ave, n1, n2)
+            valid = input_model.dq[0:new_n0, ...].reshape(shape) == 0
+            # Upstream steps may store np.ma arrays: valid already encodes dq,
+            # reduce the unmasked data only
+            fields = [np.ma.getdata(a)[0:new_n0, ...].reshape(shape) for a in
+                      (input_model.data, input_model.var_poisson, input_model.var_rnoise)]
+            
+            count = np.empty((valid.shape[0], n1, n2), dtype=np.intp)
+            averages = [np.empty(count.shape, dtype=a.dtype) for a in fields]
+            
+            def average_bin(b):
+                # All fields of a time bin are reduced together, so that the bin
+                # mask is read once and stays in cache across the reductions
+                count[b] = np.count_nonzero(valid[b], axis=1)
+                for a, ave in zip(fields, averages):
+                    _masked_mean(a[b], valid[b], count[b], out=ave[b])
+            
+            # Time bins are independent and numpy releases the GIL
+            bins = [slice(b, b+1) for b in range(count.shape[0])]
+            with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+                list(executor.map(average_bin, bins))
+            data, varp, varr = averages
+            
+            varp /= np.maximum(count, 1)
+            varr /= np.maximum(count, 1)
+            # Negative sums (negative Poisson variance) give err = 0.0, as the
+            # masked sqrt followed by filled(0.0) used to
+            err   = np.add(varp, varr)
+            np.maximum(err, 0.0, out=err)
+            np.sqrt(err, out=err)
+            dq    = (count == 0).astype(np.uint32)
             
             
             
             out_model = datamodels.CubeModel(
-                data        = data.filled(fill_value=0.0),
+                data        = data,
                 dq          = dq,
-                var_poisson = varp.filled(fill_value=0.0),
-                var_rnoise  = varr.filled(fill_value=0.0),
-                err         = err.filled(fill_value=0.0))
+                var_poisson = varp,
+                var_rnoise  = varr,
+                err         = err)
                 
             out_model.update(input_model)
             if hasattr(input_model, 'ngroup'):
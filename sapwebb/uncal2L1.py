@@ -1,6 +1,7 @@
 import numpy as np
 import os, time
 import logging
+from functools import lru_cache
 
 
 log = logging.getLogger(__name__)
@@ -22,6 +23,9 @@ from .refcorr_custom_step import ReferenceCorrectionCustomStep
 from .flagging_custom_step import FlaggingCustomStep
 from .timeaverage_custom_step import TimeAverageStep
 
+_SAT = datamodels.dqflags.pixel['SATURATED']
+_SAT_FLAG = _SAT | datamodels.dqflags.pixel['DO_NOT_USE']
+
 def FlagSaturatedColumns(input_model, ncols=1):
     """
     Flag columns containing at least one saturated pixels as saturated.
@@ -51,20 +55,48 @@ def FlagSaturatedColumns(input_model, ncols=1):
         same data model as input_model
     """
     data = input_model
-    flag_sat = datamodels.dqflags.pixel['SATURATED'] | datamodels.dqflags.pixel['DO_NOT_USE']
 
-    idx = np.where(data.groupdq & datamodels.dqflags.pixel['SATURATED'])
-    for i, j, k in zip(idx[0], idx[1], idx[3]):
-        data.groupdq[i, j, :, k-ncols:k+ncols+1] |= flag_sat
+    # Columns with at least one saturated pixel, per integration and group
+    col_sat = np.any(data.groupdq & _SAT, axis=2)
+    
+    # Extend to the ncols adjacent columns on either side
+    col_flag = col_sat.copy()
+    for s in range(1, ncols+1):
+        col_flag[..., s:]  |= col_sat[..., :-s]
+        col_flag[..., :-s] |= col_sat[..., s:]
+    
+    data.groupdq |= (col_flag*_SAT_FLAG).astype(data.groupdq.dtype)[:, :, np.newaxis, :]
             
     return data
 
 
+@lru_cache(maxsize=None)
+def _build_step(step_class, **kwargs):
+    return step_class(**kwargs)
+
+
+def _get_step(step_class, **kwargs):
+    """
+    Return a shared instance of step_class configured with kwargs, so that
+    calling run() on many segments does not build and configure the steps
+    again each time.
+    
+    Only the construction is cached. stpipe records the input file name and
+    directory on the first call only (they are set while still None), so
+    they are reset here, otherwise output naming and input path resolution
+    would keep referring to the first segment.
+    """
+    step = _build_step(step_class, **kwargs)
+    step._input_filename = None
+    step._input_dir = None
+    return step
+
+
 def run(in_file, out_file=None, num_ave=25):
     
     # DQInitStep from STScI JWST pipeline
     start = time.time()
-    dq_init_step = DQInitStep()
+    dq_init_step = _get_step(DQInitStep)
     data = dq_init_step(in_file)
     end = time.time()
     log.info('DQInitStep Completed in {:.2f} s'.format(end-start))
@@ -72,28 +104,28 @@ def run(in_file, out_file=None, num_ave=25):
    
     # SaturationStep from STScI JWST pipeline
     start = time.time()
-    saturation_step = SaturationStep()
+    saturation_step = _get_step(SaturationStep)
     data = saturation_step.run(data)
     end = time.time()
     log.info('SaturationStep Completed in {:.2f} s'.format(end-start))
 
     # SuperBiasStep from STScI JWST pipeline
     start = time.time()
-    superbias_step = SuperBiasStep()
+    superbias_step = _get_step(SuperBiasStep)
     data = superbias_step.run(data)
     end = time.time()
     log.info('SuperBiasStep Completed in {:.2f} s'.format(end-start))
     
     # LinearityStep from STScI JWST pipeline
     start = time.time()
-    linearity_step = LinearityStep()
+    linearity_step = _get_step(LinearityStep)
     data = linearity_step.run(data)
     end = time.time()
     log.info('LinearityStep Completed in {:.2f} s'.format(end-start))
 
     # DarkCurrentStep from STScI JWST pipeline
     start = time.time()
-    dark_step = DarkCurrentStep()
+    dark_step = _get_step(DarkCurrentStep)
     data = dark_step.run(data)
     end = time.time()
     log.info('DarkCurrentStep Completed in {:.2f} s'.format(end-start))
@@ -106,7 +138,7 @@ def run(in_file, out_file=None, num_ave=25):
 
     # CDSCustomStep
     start = time.time()
-    cds_step = CDSCustomStep()
+    cds_step = _get_step(CDSCustomStep)
     data_cube = cds_step(data)
     end = time.time()
     log.info('CDSCustomStep Completed in {:.2f} s'.format(end-start))    
@@ -115,14 +147,14 @@ def run(in_file, out_file=None, num_ave=25):
     
     # ReferenceCorrectionStep 
     start = time.time()
-    ref_corr = ReferenceCorrectionCustomStep()
+    ref_corr = _get_step(ReferenceCorrectionCustomStep, inplace=True)
     data_cube = ref_corr(data_cube)
     end = time.time()
     log.info('ReferenceCorrectionStep Completed in {:.2f} s'.format(end-start))    
     
     # FlaggingCustomStep 
     start = time.time()
-    flag_step = FlaggingCustomStep()
+    flag_step = _get_step(FlaggingCustomStep)
     data_cube = flag_step(data_cube)
     end = time.time()
     log.info('FlaggingCustomStep Completed in {:.2f} s'.format(end-start))    
@@ -130,25 +162,25 @@ def run(in_file, out_file=None, num_ave=25):
 
     # TimeAverageStep 
     start = time.time()
-    ta_step = TimeAverageStep(num_ave=num_ave)
+    ta_step = _get_step(TimeAverageStep, num_ave=num_ave)
     data_cube_mean = ta_step(data_cube)
     end = time.time()
     log.info('FlaggingCustomStep Completed in {:.2f} s'.format(end-start))    
     
     # AssignWcsStep from STScI JWST pipeline
-    assignWcs = AssignWcsStep()
+    assignWcs = _get_step(AssignWcsStep)
     data_cube_mean = assignWcs.run(data_cube_mean)
     
     # SourceTypeStep from STScI JWST pipeline
-    srctype=SourceTypeStep()
+    srctype=_get_step(SourceTypeStep)
     data_cube_mean = srctype(data_cube_mean)
     
     # Extract2dStep from STScI JWST pipeline
-    extract2d = Extract2dStep()
+    extract2d = _get_step(Extract2dStep)
     _dd_ = extract2d(data_cube_mean)
     
     # WavecorrStep from STScI JWST pipeline
-    wavecorr = WavecorrStep()
+    wavecorr = _get_step(WavecorrStep)
     _dd_ = wavecorr(_dd_)
     
     # Here I assign the wavelength solution to the datacube, avoiding